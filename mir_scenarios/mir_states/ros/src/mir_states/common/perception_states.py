@@ -1,106 +1,131 @@
 #!/usr/bin/python
 
+import threading
+
 import mas_perception_msgs.msg
 import mir_controller_msgs.srv
 import rospy
 import smach
 import std_msgs.msg
-import tf
 
 
 class do_visual_servoing(smach.State):
 
     SERVER = "/mir_controllers/visual_servoing/do_visual_servoing"
+    OUTCOMES = ["succeeded", "failed", "timeout", "lost_object"]
+    INPUT_KEYS = ["vscount"]
+    OUTPUT_KEYS = ["vscount"]
+    ERROR_CODE_OUTCOMES = {
+        0: "succeeded",
+        -1: "failed",
+        -2: "timeout",
+        -3: "lost_object",
+    }
 
     def __init__(self):
         smach.State.__init__(
             self,
-            outcomes=["succeeded", "failed", "timeout", "lost_object"],
-            input_keys=["vscount"],
-            output_keys=["vscount"],
+            outcomes=self.OUTCOMES,
+            input_keys=self.INPUT_KEYS,
+            output_keys=self.OUTPUT_KEYS,
         )
-        self.do_vs = rospy.ServiceProxy(
-            self.SERVER, mir_controller_msgs.srv.StartVisualServoing
+        self.do_vs = self._create_proxy()
+
+    def _create_proxy(self):
+        return rospy.ServiceProxy(
+            self.SERVER, mir_controller_msgs.srv.StartVisualServoing, persistent=True
         )
 
     def execute(self, userdata):
         try:
-            rospy.loginfo("Calling service <<%s>>" % self.SERVER)
+            rospy.loginfo("Calling service <<%s>>", self.SERVER)
             response = self.do_vs()
         except rospy.ServiceException as e:
             userdata.vscount = 0
-            rospy.logerr(
-                "Exception when calling service <<%s>>: %s" % (self.SERVER, str(e))
-            )
+            rospy.logerr("Exception when calling service <<%s>>: %s", self.SERVER, e)
+            # the persistent connection is unusable now, reconnect on next call
+            self.do_vs.close()
+            self.do_vs = self._create_proxy()
             return "failed"
-        if response.return_value.error_code == 0:
+        error_code = response.return_value.error_code
+        if error_code == 0:
             userdata.vscount = 0
             return "succeeded"
-        elif response.return_value.error_code == -1:
-            return "failed"
-        elif response.return_value.error_code == -2:
-            return "timeout"
-        elif response.return_value.error_code == -3:
-            return "lost_object"
+        return self.ERROR_CODE_OUTCOMES.get(error_code, "failed")
 
 
 class find_cavities(smach.State):
+
+    CAVITY_TOPIC = "/mcr_perception/cavity_message_builder/output/cavity"
+    CAVITY_TIMEOUT = 5.0  # wait for the cavity message max. 5 seconds
+    OUTCOMES = ["succeeded", "failed"]
+    INPUT_KEYS = ["selected_objects", "found_cavities"]
+    OUTPUT_KEYS = ["found_cavities"]
+
     def __init__(self):
         smach.State.__init__(
             self,
-            outcomes=["succeeded", "failed"],
-            input_keys=["selected_objects", "found_cavities"],
-            output_keys=["found_cavities"],
+            outcomes=self.OUTCOMES,
+            input_keys=self.INPUT_KEYS,
+            output_keys=self.OUTPUT_KEYS,
         )
 
         self.sub_cavity = rospy.Subscriber(
-            "/mcr_perception/cavity_message_builder/output/cavity",
+            self.CAVITY_TOPIC,
             mas_perception_msgs.msg.Cavity,
             self.cavity_cb,
+            tcp_nodelay=True,
         )
         self.pub_contour_finder_event = rospy.Publisher(
-            "/mcr_perception/contour_finder/input/event_in", std_msgs.msg.String
+            "/mcr_perception/contour_finder/input/event_in",
+            std_msgs.msg.String,
+            queue_size=1,
+            tcp_nodelay=True,
         )
         self.pub_object_category = rospy.Publisher(
             "/mcr_perception/cavity_template_publisher/input/object_name",
             std_msgs.msg.String,
+            queue_size=1,
+            latch=True,
+            tcp_nodelay=True,
         )
-        self.tf_listener = tf.TransformListener()
         self.cavity = None
+        self._cavity_evt = threading.Event()
+        rospy.on_shutdown(self._cavity_evt.set)
 
     def cavity_cb(self, cavity):
         self.cavity = cavity
+        self._cavity_evt.set()
 
     def execute(self, userdata):
         local_found_cavities = []
         for obj in userdata.selected_objects:
+            if rospy.is_shutdown():
+                break
+            self._cavity_evt.clear()
             self.cavity = None
             self.pub_object_category.publish(obj.name)
             self.pub_contour_finder_event.publish("e_trigger")
 
-            timeout = rospy.Duration.from_sec(
-                5.0
-            )  # wait for the done event max. 5 seconds
-            start_time = rospy.Time.now()
-            while not rospy.is_shutdown():
-                if self.cavity:
-                    rospy.loginfo(
-                        "Received Cavity message for %s, matching error: %.5f",
-                        obj.name,
-                        self.cavity.template_matching_error.matching_error,
-                    )
-                    self.cavity.object_name = obj.name
-                    local_found_cavities.append(self.cavity)
-                    break
-
-                if (rospy.Time.now() - start_time) > timeout:
-                    rospy.logwarn(
-                        "timeout of %f seconds exceeded for finding cavity"
-                        % float(timeout.to_sec())
-                    )
-                    break
-
-                rospy.sleep(0.01)
+            self._cavity_evt.wait(self.CAVITY_TIMEOUT)
+            cavity = self.cavity
+            if cavity:
+                rospy.loginfo(
+                    "Received Cavity message for %s, matching error: %.5f",
+                    obj.name,
+                    cavity.template_matching_error.matching_error,
+                )
+                cavity.object_name = obj.name
+                local_found_cavities.append(cavity)
+            elif rospy.is_shutdown():
+                # the wait was cut short by on_shutdown, not by a timeout
+                rospy.logwarn("shutdown while waiting for cavity of %s", obj.name)
+                break
+            else:
+                rospy.logwarn(
+                    "timeout of %f seconds exceeded for finding cavity",
+                    self.CAVITY_TIMEOUT,
+                )
 
         if len(local_found_cavities) == 0:
             return "failed"
@@ -111,11 +136,15 @@ class find_cavities(smach.State):
 
 
 class check_found_cavities(smach.State):
+
+    OUTCOMES = ["cavities_found", "no_cavities_found"]
+    INPUT_KEYS = ["best_matched_cavities"]
+
     def __init__(self):
         smach.State.__init__(
             self,
-            outcomes=["cavities_found", "no_cavities_found"],
-            input_keys=["best_matched_cavities"],
+            outcomes=self.OUTCOMES,
+            input_keys=self.INPUT_KEYS,
         )
 
     def execute(self, userdata):
@@ -127,12 +156,17 @@ class check_found_cavities(smach.State):
 
 
 class find_best_matched_cavities(smach.State):
+
+    OUTCOMES = ["succeeded", "complete"]
+    INPUT_KEYS = ["best_matched_cavities", "found_cavities"]
+    OUTPUT_KEYS = ["best_matched_cavities"]
+
     def __init__(self):
         smach.State.__init__(
             self,
-            outcomes=["succeeded", "complete"],
-            input_keys=["best_matched_cavities", "found_cavities"],
-            output_keys=["best_matched_cavities"],
+            outcomes=self.OUTCOMES,
+            input_keys=self.INPUT_KEYS,
+            output_keys=self.OUTPUT_KEYS,
         )
 
         self.matching_threshold = 0.1
@@ -140,24 +174,32 @@ class find_best_matched_cavities(smach.State):
 
     def execute(self, userdata):
 
-        for cavity in userdata.found_cavities:
-            exists = False
-            for idx, c in enumerate(userdata.best_matched_cavities):
-                if cavity.object_name == c.object_name:
-                    if (
-                        cavity.template_matching_error.matching_error
-                        < c.template_matching_error.matching_error
-                    ):
-                        userdata.best_matched_cavities[idx] = cavity
-                        print "Found better cavity for ", cavity.object_name, ". Old: ", c.template_matching_error.matching_error, " New: ", cavity.template_matching_error.matching_error
-                    exists = True
-
-            if exists == False:
-                if (
-                    cavity.template_matching_error.matching_error
-                    < self.matching_threshold
-                ):
-                    userdata.best_matched_cavities.append(cavity)
+        found_cavities = userdata.found_cavities
+        if found_cavities:
+            best_matched_cavities = userdata.best_matched_cavities
+            threshold = self.matching_threshold
+            existing = {
+                c.object_name: (idx, c) for idx, c in enumerate(best_matched_cavities)
+            }
+            for cavity in found_cavities:
+                name = cavity.object_name
+                error = cavity.template_matching_error.matching_error
+                hit = existing.get(name)
+                if hit is not None:
+                    idx, c = hit
+                    old_error = c.template_matching_error.matching_error
+                    if error < old_error:
+                        best_matched_cavities[idx] = cavity
+                        existing[name] = (idx, cavity)
+                        rospy.loginfo(
+                            "Found better cavity for %s. Old: %.5f New: %.5f",
+                            name,
+                            old_error,
+                            error,
+                        )
+                elif error < threshold:
+                    existing[name] = (len(best_matched_cavities), cavity)
+                    best_matched_cavities.append(cavity)
 
         if self.loop_count >= 2:
             self.loop_count = 0